@@ -5,6 +5,9 @@ import threading
 import os
 import sys
 import time
+import json
+import functools
+import concurrent.futures
 
 APP_FOLDER_NAME = "Tap2iD"
 
@@ -40,7 +43,7 @@ logger = logging.getLogger(__name__)
 logger.debug("Current working directory: %s", os.getcwd())
 
 from bumble.core import UUID, AdvertisingData
-from bumble.device import Device, Connection, Peer
+from bumble.device import Device, Connection, Peer, AdvertisingParameters, AdvertisingEventProperties, ConnectionParametersPreferences
 from bumble.gatt import (
     Service,
     Characteristic,
@@ -52,14 +55,24 @@ from bumble.gatt import (
 )
 from bumble.transport import open_transport_or_link
 from bumble.utils import AsyncRunner
-from bumble.hci import Address
+from bumble.hci import Address, HCI_CENTRAL_ROLE, HCI_LE_1M_PHY
 from bumble.gatt import GATT_CLIENT_CHARACTERISTIC_CONFIGURATION_DESCRIPTOR
 from bumble.gatt_client import ClientCharacteristicConfigurationBits
 import struct
+import base64
+import hashlib
+import hmac
+import uuid
+from collections import OrderedDict
 
 # Define the constant for state transmission.
 STATE_START_TRANSMISSION = 0x01
 
+# Dwell time of each advertising set when rotating on a legacy-only controller.
+ADVERTISING_ROTATION_INTERVAL = 0.5
+# Highest advertising SID; extended advertising sets beyond this are not addressable.
+MAX_ADVERTISING_SID = 15
+
 # Global variable to store the server-to-client characteristic for later notifications.
 global_server2client_characteristic = None
 
@@ -80,6 +93,10 @@ global_state_characteristic = None
 # Will hold the Peer object once connected
 _global_peer: Peer = None
 _global_device = None
+_global_device_transport = None
+
+# Strong references to fire-and-forget tasks until they finish.
+_background_tasks = set()
 
 # Will hold the two characteristics once we discover them for client
 _global_char_client2server = None
@@ -117,6 +134,13 @@ def start_persistent_event_loop():
 # Kick off our background loop immediately when the module loads
 start_persistent_event_loop()
 
+def spawn_task(coro):
+    # Must be called on the event loop thread.
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 def disconnect_event_loop():
     global global_event_loop, loop_thread
     if global_event_loop is not None:
@@ -127,12 +151,347 @@ def disconnect_event_loop():
         loop_thread.join(timeout=5)
         logger.info("Persistent event loop thread stopped")
 
+# ------------------------------------------------------------------------------
+# Opt-in session profiling
+#
+# Enabled with BUMBLE_PROFILE_EVERY=<N> (profile every Nth session) and/or
+# BUMBLE_PROFILE_THRESHOLD=<seconds> (only keep sessions slower than this), or at
+# runtime with enable_profiling(). A sampler thread records the loop thread's
+# stack every BUMBLE_PROFILE_INTERVAL seconds and asyncio tasks are timed by
+# coroutine name. Results are written next to bluetooth_bumble.log as a
+# collapsed-stack file (for flamegraph.pl / speedscope) and a task summary.
+# ------------------------------------------------------------------------------
+class SessionProfiler:
+    def __init__(self, name: str, interval: float):
+        self.name = name
+        self.interval = interval
+        self.stacks = {}
+        self.task_times = {}
+        self.start_time = None
+        self._stop_event = threading.Event()
+        self._sampler = None
+        self._previous_task_factory = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        global_event_loop.call_soon_threadsafe(self._install_task_factory)
+
+    def stop(self) -> float:
+        duration = time.perf_counter() - self.start_time
+        self._stop_event.set()
+        self._sampler.join(timeout=1.0)
+        global_event_loop.call_soon_threadsafe(global_event_loop.set_task_factory, self._previous_task_factory)
+        return duration
+
+    def _sample(self):
+        loop_thread_id = loop_thread.ident
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(loop_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def _install_task_factory(self):
+        self._previous_task_factory = global_event_loop.get_task_factory()
+
+        def task_factory(loop, coro, **kwargs):
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+            name = getattr(coro, "__qualname__", type(coro).__name__)
+            created = time.perf_counter()
+
+            def on_done(_):
+                count, total = self.task_times.get(name, (0, 0.0))
+                self.task_times[name] = (count + 1, total + time.perf_counter() - created)
+            task.add_done_callback(on_done)
+            return task
+        global_event_loop.set_task_factory(task_factory)
+
+    def dump(self, duration: float):
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        base = os.path.join(app_folder_path, f"bluetooth_bumble_{self.name}_{stamp}")
+        with open(base + ".collapsed", "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        with open(base + ".tasks.txt", "w") as f:
+            f.write(f"session {self.name} duration {duration:.3f}s\n")
+            for name, (count, total) in sorted(self.task_times.items(), key=lambda item: -item[1][1]):
+                f.write(f"{total:10.3f}s {count:6d}  {name}\n")
+        logger.info("Profile for session %s written to %s.*", self.name, base)
+
+try:
+    _profile_every = int(os.environ.get('BUMBLE_PROFILE_EVERY', '0'))
+    _profile_threshold = float(os.environ.get('BUMBLE_PROFILE_THRESHOLD', '0'))
+    _profile_interval = float(os.environ.get('BUMBLE_PROFILE_INTERVAL', '0.005'))
+except ValueError as e:
+    logger.warning("Ignoring invalid BUMBLE_PROFILE_* setting, profiling disabled: %s", e)
+    _profile_every, _profile_threshold, _profile_interval = 0, 0.0, 0.005
+_profile_session_count = 0
+_session_profiler = None
+
+if _profile_threshold > 0 and _profile_every == 0:
+    _profile_every = 1
+
+def enable_profiling(every: int = 1, threshold: float = 0.0, interval: float = 0.005):
+    global _profile_every, _profile_threshold, _profile_interval
+    _profile_every = every
+    _profile_threshold = threshold
+    _profile_interval = interval
+    return "Profiling enabled."
+
+def disable_profiling():
+    global _profile_every
+    _profile_every = 0
+    return "Profiling disabled."
+
+def _profile_session_begin(name: str):
+    global _profile_session_count, _session_profiler
+    # A new setup means the previous session is over, even if nothing ended it.
+    _profile_session_end()
+    if _profile_every <= 0:
+        return
+    _profile_session_count += 1
+    if _profile_session_count % _profile_every != 0:
+        return
+    _session_profiler = SessionProfiler(f"{name}_{_profile_session_count}", _profile_interval)
+    _session_profiler.start()
+
+def _profile_session_end():
+    global _session_profiler
+    if _session_profiler is None:
+        return
+    profiler, _session_profiler = _session_profiler, None
+    duration = profiler.stop()
+    if duration >= _profile_threshold:
+        try:
+            profiler.dump(duration)
+        except Exception as e:
+            logger.error("Error writing session profile: %s", e)
+
+def profiled_session(name: str):
+    # Starts a session for a setup coroutine. The session ends here when the setup raises or returns None,
+    # and otherwise keeps running until termination or disconnect.
+    def decorate(setup):
+        @functools.wraps(setup)
+        async def wrapper(*args, **kwargs):
+            _profile_session_begin(name)
+            result = None
+            try:
+                result = await setup(*args, **kwargs)
+                return result
+            finally:
+                if result is None:
+                    _profile_session_end()
+        return wrapper
+    return decorate
+
+# ------------------------------------------------------------------------------
+# Adaptive transfer tuning
+#
+# Each session starts with the best mode remembered for the peer (by resolved
+# address). Until every candidate mode has a history, each message goes out in a
+# mode that has not been tried yet. Goodput is measured on the outgoing transfer
+# only, from its first frame until the last one has completed or been
+# acknowledged; unacknowledged writes are followed by an ATT read so the transfer
+# ends when the peer has actually received them. The holder's consent time is
+# therefore never part of it. A failed frame, or an answer that stalls for
+# TUNER_ANSWER_TIMEOUT once the peer has started sending it, counts as a loss and
+# moves the session to the next mode. Results for identity addresses are stored
+# in bluetooth_bumble_tuning.json next to bluetooth_bumble.log.
+# ------------------------------------------------------------------------------
+WRITE_WITHOUT_RESPONSE = "write_without_response"
+WRITE_WITH_RESPONSE = "write_with_response"
+NOTIFY = "notify"
+INDICATE = "indicate"
+
+CLIENT_TRANSFER_MODES = [WRITE_WITHOUT_RESPONSE, WRITE_WITH_RESPONSE]
+TUNER_ANSWER_TIMEOUT = 5.0
+TUNER_MAX_PEERS = 256
+tuning_file_path = os.path.join(app_folder_path, "bluetooth_bumble_tuning.json")
+
+_peer_transfer_profiles = None
+
+def _load_transfer_profiles():
+    global _peer_transfer_profiles
+    if _peer_transfer_profiles is None:
+        _peer_transfer_profiles = OrderedDict()
+        try:
+            with open(tuning_file_path) as f:
+                _peer_transfer_profiles.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("Ignoring unreadable tuning file: %s", e)
+    return _peer_transfer_profiles
+
+def _save_transfer_profiles():
+    try:
+        with open(tuning_file_path, "w") as f:
+            json.dump(_peer_transfer_profiles, f, indent=1)
+    except Exception as e:
+        logger.error("Error writing tuning file: %s", e)
+
+class TransferTuner:
+    def __init__(self, peer_address: Address, modes):
+        self.peer_key = str(peer_address)
+        # An unresolved private address is never seen again; do not store results under it.
+        self.persistent = not peer_address.is_resolvable
+        self.modes = list(modes)
+        self.session = {mode: {"bytes": 0, "seconds": 0.0, "messages": 0, "losses": 0} for mode in self.modes}
+        profile = _load_transfer_profiles().get(self.peer_key, {})
+        self.untried = [mode for mode in self.modes if mode not in profile]
+        # The transfer in flight: its mode, its size so far and when its first frame went out.
+        self.message_mode = None
+        self.message_bytes = 0
+        self.message_start = None
+        # The mode of the last completed transfer, which the peer's answer is charged to.
+        self.answer_mode = None
+        self._answer_timer = None
+        self.mode = self._best_known_mode(profile)
+        self.locked = self.mode is not None
+        if self.mode is None:
+            self.mode = self.untried[0] if self.untried else self.modes[0]
+        logger.info("Transfer tuner for %s: starting with %s (%s)",
+                    self.peer_key, self.mode, "remembered" if self.locked else "probing")
+
+    def _best_known_mode(self, profile):
+        # Keep probing until every mode has a history.
+        if self.untried:
+            return None
+        return min(self.modes, key=lambda mode: (profile[mode]["losses"] / profile[mode]["sessions"], -profile[mode]["goodput"]))
+
+    def record_frame(self, mode: str, size: int):
+        # Called before the frame goes out.
+        if self.message_start is None:
+            self.message_mode = mode
+            self.message_bytes = 0
+            self.message_start = time.perf_counter()
+        self.message_bytes += size
+
+    def record_failure(self, mode: str):
+        self._message_lost(mode, "failed frame")
+
+    def transfer_completed(self):
+        # The last frame has completed, or has been acknowledged.
+        if self.message_start is None:
+            return
+        mode = self.message_mode
+        stats = self.session[mode]
+        stats["bytes"] += self.message_bytes
+        stats["seconds"] += time.perf_counter() - self.message_start
+        stats["messages"] += 1
+        self.message_start = None
+        self.answer_mode = mode
+        if mode in self.untried:
+            self.untried.remove(mode)
+        if not self.locked:
+            if self.untried:
+                self.mode = self.untried[0]
+            else:
+                self.mode = max(self.modes, key=self._session_score)
+                self.locked = True
+                logger.info("Transfer tuner for %s: settled on %s", self.peer_key, self.mode)
+
+    def answer_frame_received(self, final: bool):
+        # Runs on the event loop. Only a started answer is timed, so the holder's consent is not.
+        self._cancel_answer_timer()
+        if self.answer_mode is None:
+            return
+        if final:
+            self.answer_mode = None
+        else:
+            self._answer_timer = global_event_loop.call_later(TUNER_ANSWER_TIMEOUT, self._answer_timed_out)
+
+    def _answer_timed_out(self):
+        self._answer_timer = None
+        if self.answer_mode is not None:
+            self._message_lost(self.answer_mode, "stalled answer")
+
+    def _cancel_answer_timer(self):
+        timer, self._answer_timer = self._answer_timer, None
+        if timer is not None:
+            timer.cancel()
+
+    def _message_lost(self, mode: str, reason: str):
+        self.message_start = None
+        self.answer_mode = None
+        self.session[mode]["losses"] += 1
+        if mode in self.untried:
+            self.untried.remove(mode)
+        self._switch_from(mode, reason)
+
+    def _session_score(self, mode):
+        stats = self.session[mode]
+        if stats["losses"]:
+            return -1.0
+        if not stats["messages"]:
+            # Not used this session: fall back to the remembered goodput.
+            return _load_transfer_profiles().get(self.peer_key, {}).get(mode, {}).get("goodput", 0.0)
+        return stats["bytes"] / max(stats["seconds"], 1e-6)
+
+    def _switch_from(self, mode, reason):
+        alternatives = [m for m in self.modes if m != mode]
+        if alternatives:
+            self.mode = alternatives[0]
+            logger.warning("Transfer tuner for %s: %s with %s, switching to %s", self.peer_key, reason, mode, self.mode)
+
+    def finish(self):
+        # Runs on the event loop, from the disconnection handlers.
+        if self._answer_timer is not None:
+            # The link dropped in the middle of the peer's answer.
+            self._cancel_answer_timer()
+            self.session[self.answer_mode]["losses"] += 1
+        self.message_start = None
+        self.answer_mode = None
+
+        if not self.persistent or not any(stats["messages"] or stats["losses"] for stats in self.session.values()):
+            return
+        profiles = _load_transfer_profiles()
+        profile = profiles.pop(self.peer_key, {})
+        for mode, stats in self.session.items():
+            if not stats["messages"] and not stats["losses"]:
+                continue
+            entry = profile.setdefault(mode, {"goodput": 0.0, "losses": 0, "sessions": 0})
+            if stats["messages"]:
+                goodput = stats["bytes"] / max(stats["seconds"], 1e-6)
+                entry["goodput"] = goodput if not entry["sessions"] else 0.7 * entry["goodput"] + 0.3 * goodput
+            entry["losses"] += 1 if stats["losses"] else 0
+            entry["sessions"] += 1
+        profiles[self.peer_key] = profile
+        while len(profiles) > TUNER_MAX_PEERS:
+            profiles.popitem(last=False)
+        _save_transfer_profiles()
+
+_client_tuner = None
+_server_tuner = None
+
+def finish_client_tuning():
+    global _client_tuner
+    if _client_tuner is not None:
+        tuner, _client_tuner = _client_tuner, None
+        tuner.finish()
+
+def finish_server_tuning():
+    global _server_tuner
+    if _server_tuner is not None:
+        tuner, _server_tuner = _server_tuner, None
+        tuner.finish()
+
 # ------------------------------------------------------------------------------
 # Listener for connection events
 # ------------------------------------------------------------------------------
 class MyListener(Device.Listener, Connection.Listener):
     def __init__(self, device):
         self.device = device
+        # Connection of the accepted wallet once several engagements are advertised; None accepts any.
+        self.server_connection = None
+        self.subscribed_modes = {}
 
     def on_connection(self, connection):
         logger.info(f'=== Connected to {connection}')
@@ -145,14 +504,38 @@ class MyListener(Device.Listener, Connection.Listener):
 
     def on_disconnection(self, reason):
         logger.info(f'### Disconnected, reason={reason}')
+        connections = list(self.device.connections.values())
+        for connection in [c for c in self.subscribed_modes if c not in connections]:
+            del self.subscribed_modes[connection]
+        # A wallet dropped after losing the race to another engagement does not end the session.
+        if self.server_connection is not None and self.server_connection in connections:
+            return
+        # Drop any partial message so it cannot leak into the next session.
+        global_received_data.clear()
+        finish_server_tuning()
 
     def on_characteristic_subscription(self, connection, characteristic, notify_enabled, indicate_enabled):
+        global _server_tuner
         logger.info(
             f'$$$ Characteristic subscription for uuid {characteristic.uuid} '
             f'from {connection}: '
             f'notify {"enabled" if notify_enabled else "disabled"}, '
             f'indicate {"enabled" if indicate_enabled else "disabled"}'
         )
+        # Every engagement has its own server2client characteristic; match them all by UUID.
+        if characteristic.uuid == PERIPHERAL_SERVER2CLIENT_UUID:
+            # Only the modes the wallet enabled are candidates.
+            modes = [mode for mode, enabled in ((NOTIFY, notify_enabled), (INDICATE, indicate_enabled)) if enabled]
+            self.subscribed_modes[connection] = modes
+            if self.server_connection is None or self.server_connection is connection:
+                _server_tuner = TransferTuner(connection.peer_address, modes) if modes else None
+
+    def accept(self, connection):
+        global _server_tuner
+        self.server_connection = connection
+        # Another wallet may have subscribed last; tune for the accepted one.
+        modes = self.subscribed_modes.get(connection)
+        _server_tuner = TransferTuner(connection.peer_address, modes) if modes else None
 
 # ------------------------------------------------------------------------------
 # Characteristic read/write handlers
@@ -185,6 +568,8 @@ def client2server_write_callback(conn, value):
 
     # Read the marker from the first byte.
     marker = value[0]
+    if _server_tuner is not None and marker in (0x00, 0x01):
+        _server_tuner.answer_frame_received(marker == 0x00)
 
     if marker == 0x01:
         if len(global_received_data) == 0:
@@ -229,13 +614,16 @@ def state_write_callback(conn, value, state_future: asyncio.Future):
 # ------------------------------------------------------------------------------
 # Create custom characteristics and service
 # ------------------------------------------------------------------------------
+# Server-to-client characteristic of the reader's own (peripheral server) service.
+PERIPHERAL_SERVER2CLIENT_UUID = UUID("00000007-a123-48ce-896b-4c76973373e6")
+
 def create_custom_service(custom_service_uuid: UUID, state_write_event, ident_value: bytes) -> Service:
     global global_server2client_characteristic, global_state_characteristic # Explicitly declare global here
     
     # Define characteristic UUIDs for the custom service
     state_uuid         = UUID("00000005-a123-48ce-896b-4c76973373e6")
     client2server_uuid = UUID("00000006-a123-48ce-896b-4c76973373e6")
-    server2client_uuid = UUID("00000007-a123-48ce-896b-4c76973373e6")
+    server2client_uuid = PERIPHERAL_SERVER2CLIENT_UUID
     ident_uuid         = UUID("00000008-a123-48ce-896b-4c76973373e6")
     l2cap_uuid         = UUID("0000000b-a123-48ce-896b-4c76973373e6")
     
@@ -261,7 +649,7 @@ def create_custom_service(custom_service_uuid: UUID, state_write_event, ident_va
     # This characteristic is used for sending notifications from the server to the client.
     global_server2client_characteristic = Characteristic(
         uuid=server2client_uuid,
-        properties=Characteristic.Properties.READ | Characteristic.Properties.NOTIFY,
+        properties=Characteristic.Properties.READ | Characteristic.Properties.NOTIFY | Characteristic.Properties.INDICATE,
         permissions=Characteristic.READABLE     
     )
 
@@ -303,7 +691,9 @@ def create_custom_service(custom_service_uuid: UUID, state_write_event, ident_va
 # This function sets up the BLE server, waits for the state characteristic to receive
 # a specific value (or times out), and then returns while leaving the server running.
 # ------------------------------------------------------------------------------
-async def setup_bluetooth_server(config_file: str, transport: str, service_uuid_str: str, ident_value: bytes, timeout: float = 30.0):
+@profiled_session("server")
+async def setup_bluetooth_server(config_file: str, transport: str, service_uuid_str: str, ident_value: bytes, timeout: float = 30.0,
+                                 advertising_data: bytes = None):
     logger.debug("Starting Bluetooth server setup with uuid %s.", service_uuid_str)
     custom_service_uuid = UUID(service_uuid_str)
 
@@ -340,7 +730,7 @@ async def setup_bluetooth_server(config_file: str, transport: str, service_uuid_
     await device.power_on()
 
     # Set the advertising data to include the custom service UUID (or any desired data)
-    device.advertising_data = bytes(
+    device.advertising_data = advertising_data or bytes(
         AdvertisingData(
             [
                 (
@@ -360,7 +750,7 @@ async def setup_bluetooth_server(config_file: str, transport: str, service_uuid_
             await hci_transport.source.wait_for_termination()
         except Exception as e:
             logger.error("Error waiting for termination: %s", e)
-    asyncio.create_task(keep_server_running())
+    spawn_task(keep_server_running())
 
     # Wait for a connection or timeout.
     try:
@@ -373,6 +763,190 @@ async def setup_bluetooth_server(config_file: str, transport: str, service_uuid_
     # Return the device and connection.
     return device, state_future.done()
 
+# ------------------------------------------------------------------------------
+# One advertised engagement: its own service UUID, ident value and GATT service,
+# mapped to a separate pending verification.
+# ------------------------------------------------------------------------------
+class AdvertisingEngagement:
+    def __init__(self, service_uuid_str: str, ident_value: bytes):
+        self.service_uuid_str = service_uuid_str
+        self.service_uuid = UUID(service_uuid_str)
+        self.state_future = asyncio.get_event_loop().create_future()
+        # The wallet connection that started this engagement.
+        self.connection = None
+        self.service = create_custom_service(
+            self.service_uuid,
+            self._on_state_write,
+            ident_value
+        )
+        # create_custom_service stores the characteristics globally; keep this set's own copies.
+        self.state_characteristic = global_state_characteristic
+        self.server2client_characteristic = global_server2client_characteristic
+        self.advertising_data = bytes(
+            AdvertisingData(
+                [
+                    (
+                        AdvertisingData.COMPLETE_LIST_OF_128_BIT_SERVICE_CLASS_UUIDS,
+                        bytes(self.service_uuid)
+                    )
+                ]
+            )
+        )
+        self.advertising_set = None
+
+    def _on_state_write(self, conn, value):
+        if value and value[0] == STATE_START_TRANSMISSION and not self.state_future.done():
+            self.connection = conn
+        state_write_callback(conn, value, self.state_future)
+
+# ------------------------------------------------------------------------------
+# Advertise several engagements at once and accept whichever wallet starts first.
+#
+# Controllers with LE extended advertising get one advertising set per engagement;
+# legacy controllers, and engagements that do not fit in the controller's sets (or
+# the 16 SIDs), rotate through the engagements every ADVERTISING_ROTATION_INTERVAL.
+# Returns the device and the service UUID of the engagement that was accepted.
+# ------------------------------------------------------------------------------
+@profiled_session("server")
+async def setup_bluetooth_server_sets(config_file: str, transport: str, service_uuid_strs, ident_values, timeout: float = 30.0):
+    global global_hci_transport, global_state_characteristic, global_server2client_characteristic
+    logger.debug("Starting Bluetooth server setup with uuids %s.", list(service_uuid_strs))
+
+    engagements = [
+        AdvertisingEngagement(service_uuid_str, ident_value)
+        for service_uuid_str, ident_value in zip(service_uuid_strs, ident_values)
+    ]
+    if not engagements:
+        raise ValueError("At least one engagement is required")
+
+    logger.info('<<< Connecting to HCI...')
+    hci_transport = await open_transport_or_link(transport)
+    global_hci_transport = hci_transport  # Save transport globally
+    logger.info('<<< Connected to HCI transport')
+
+    device = Device.from_config_file_with_hci(config_file, hci_transport.source, hci_transport.sink)
+    device.listener = MyListener(device)
+    device.add_services([engagement.service for engagement in engagements])
+
+    for attribute in device.gatt_server.attributes:
+        logger.debug("GATT attribute: %s", attribute)
+
+    await device.power_on()
+
+    rotation_task = None
+    use_sets = device.supports_le_extended_advertising
+    if use_sets:
+        # One set per engagement, and the SID field only holds 0-15. A count of 0 means the
+        # controller did not report it; creation failures below still fall back to rotation.
+        available = MAX_ADVERTISING_SID + 1
+        if device.host.number_of_supported_advertising_sets:
+            available = min(available, device.host.number_of_supported_advertising_sets)
+        if len(engagements) > available:
+            logger.info("%d engagements exceed the %d advertising sets available", len(engagements), available)
+            use_sets = False
+    if use_sets:
+        try:
+            for sid, engagement in enumerate(engagements):
+                engagement.advertising_set = await device.create_advertising_set(
+                    advertising_parameters=AdvertisingParameters(
+                        advertising_event_properties=AdvertisingEventProperties(
+                            is_connectable=True,
+                            is_scannable=True,
+                            is_legacy=True
+                        ),
+                        advertising_sid=sid
+                    ),
+                    advertising_data=engagement.advertising_data,
+                    auto_restart=True
+                )
+                logger.info(f"Advertising set {sid} for custom service UUID: {engagement.service_uuid}")
+        except Exception as e:
+            # Do not leave part of the engagements advertised; rotate through all of them instead.
+            logger.warning("Creating advertising sets failed (%s)", e)
+            for engagement in engagements:
+                if engagement.advertising_set:
+                    try:
+                        await engagement.advertising_set.remove()
+                    except Exception as remove_error:
+                        logger.warning("Failed to remove advertising set: %s", remove_error)
+                    engagement.advertising_set = None
+            use_sets = False
+    if not use_sets:
+        async def rotate_advertising():
+            index = 0
+            while True:
+                engagement = engagements[index % len(engagements)]
+                if device.is_advertising:
+                    await device.stop_advertising()
+                if device.connections:
+                    # A wallet is connected; wait for it to select its engagement.
+                    await asyncio.sleep(ADVERTISING_ROTATION_INTERVAL)
+                    continue
+                device.advertising_data = engagement.advertising_data
+                await device.start_advertising(auto_restart=False)
+                await asyncio.sleep(ADVERTISING_ROTATION_INTERVAL)
+                index += 1
+        logger.info("Rotating %d engagements on the legacy advertising set", len(engagements))
+        rotation_task = asyncio.create_task(rotate_advertising())
+
+    async def keep_server_running():
+        try:
+            await hci_transport.source.wait_for_termination()
+        except Exception as e:
+            logger.error("Error waiting for termination: %s", e)
+    spawn_task(keep_server_running())
+
+    # Wait for the first engagement to receive the "start transmission" state.
+    futures = {engagement.state_future: engagement for engagement in engagements}
+    done, _ = await asyncio.wait(futures.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+    if rotation_task:
+        rotation_task.cancel()
+        try:
+            await rotation_task
+        except asyncio.CancelledError:
+            pass
+
+    if not done:
+        logger.warning("Timeout waiting for connection after %s seconds", timeout)
+        for engagement in engagements:
+            if engagement.advertising_set:
+                await engagement.advertising_set.stop()
+        if device.is_advertising:
+            await device.stop_advertising()
+        raise asyncio.TimeoutError()
+
+    accepted = futures[done.pop()]
+    logger.info("State event received for %s; returning from setup.", accepted.service_uuid)
+
+    # Stop advertising the engagements that were not accepted.
+    for engagement in engagements:
+        if engagement is accepted:
+            continue
+        engagement.state_future.cancel()
+        if engagement.advertising_set:
+            await engagement.advertising_set.stop()
+    if device.is_advertising:
+        await device.stop_advertising()
+
+    # Wallets connected to the other engagements would otherwise keep writing into the shared receive buffer.
+    device.listener.accept(accepted.connection)
+    for connection in list(device.connections.values()):
+        if connection is accepted.connection:
+            continue
+        logger.info(f"Disconnecting {connection}: its engagement was not accepted")
+        try:
+            await connection.disconnect()
+        except Exception as e:
+            logger.warning(f"Failed to disconnect {connection}: {e}")
+    # The reader speaks first, so anything buffered so far came from a dropped wallet.
+    global_received_data.clear()
+
+    global_state_characteristic = accepted.state_characteristic
+    global_server2client_characteristic = accepted.server2client_characteristic
+
+    return device, accepted.service_uuid_str
+
 def get_server2client_characteristic():
     return global_server2client_characteristic
    
@@ -397,10 +971,17 @@ async def send_data_to_client(device, data: bytes):
             return
 
     logger.info("Data send to client: %s", data.hex())
+    tuner = _server_tuner
+    mode = tuner.mode if tuner is not None else NOTIFY
+    if tuner is not None:
+        tuner.record_frame(mode, len(data))
     try:
         # Set characteristic value before notifying
         global_server2client_characteristic.value = data
-        result = await device.gatt_server.notify_subscribers(global_server2client_characteristic)
+        if mode == INDICATE:
+            result = await device.gatt_server.indicate_subscribers(global_server2client_characteristic)
+        else:
+            result = await device.gatt_server.notify_subscribers(global_server2client_characteristic)
             
         if not result:
             logger.warning("No subscribers received the notification!")
@@ -408,9 +989,13 @@ async def send_data_to_client(device, data: bytes):
             logger.info("Notification sent successfully to %d subscribers", len(result))
             for res in result:
                 logger.info("Client received status: %s", getattr(res, "Status", "N/A"))
+        if tuner is not None and data[:1] == b'\x00':
+            tuner.transfer_completed()
 
     except Exception as e:
         logger.error("Error during notification: %s", e)
+        if tuner is not None:
+            tuner.record_failure(mode)
 
 # ------------------------------------------------------------------------------
 # Disconnect method that closes the HCI transport and then stops the event loop.
@@ -433,6 +1018,7 @@ def disconnect():
     # Clear the global characteristic references so that a new connection will reinitialize them.
     global_state_characteristic = None
     global_server2client_characteristic = None
+    _profile_session_end()
 
 async def send_session_termination(device):
     logger.info("send_session_termination")
@@ -450,6 +1036,7 @@ async def send_session_termination(device):
         logger.info("Session termination notification sent successfully. Subscribers: %d", len(result) if result else 0)
     except Exception as e:
         logger.error("Error sending session termination: %s", e)
+    _profile_session_end()
 
 # -----------------------------------------------------------------------------
 #  Gatt Client
@@ -459,6 +1046,46 @@ CLIENT2SERVER_UUID  = UUID("00000002-a123-48ce-896b-4c76973373e6")
 SERVER2CLIENT_UUID  = UUID("00000003-a123-48ce-896b-4c76973373e6")
 CCCD_UUID = UUID("00002902-0000-1000-8000-00805F9B34FB")
 
+# How long a direct connection to a known address may take before falling back to scanning.
+DIRECT_CONNECT_TIMEOUT = 1.5
+RECENT_PEER_CACHE_SIZE = 16
+# Without a handover address, only a wallet seen this recently is tried directly.
+RECENT_PEER_MAX_AGE = 60.0
+
+# Connection parameters used for direct connections (intervals in ms).
+FAST_CONNECTION_PARAMETERS = {
+    HCI_LE_1M_PHY: ConnectionParametersPreferences(
+        connection_interval_min=7.5,
+        connection_interval_max=15,
+        max_latency=0
+    )
+}
+
+# Wallets recently connected to, by identity address, with the time they were last seen.
+# Service UUIDs are fresh per engagement and private addresses rotate, so only identity
+# addresses (as resolved through the keystore) identify a wallet across sessions.
+_recent_peer_addresses = OrderedDict()
+
+def remember_peer_address(connection):
+    address = connection.peer_address
+    if address.is_resolvable:
+        # The keystore could not resolve it; the address will not be used again.
+        return
+    key = str(address)
+    _recent_peer_addresses.pop(key, None)
+    _recent_peer_addresses[key] = (address, time.monotonic())
+    while len(_recent_peer_addresses) > RECENT_PEER_CACHE_SIZE:
+        _recent_peer_addresses.popitem(last=False)
+
+def forget_peer_address(address):
+    _recent_peer_addresses.pop(str(address), None)
+
+def get_recent_peer_address():
+    if not _recent_peer_addresses:
+        return None
+    address, seen = next(reversed(_recent_peer_addresses.values()))
+    return address if time.monotonic() - seen <= RECENT_PEER_MAX_AGE else None
+
 """
     Register a Python callable (from .NET) that will be
     invoked with each notification's raw bytes.
@@ -468,6 +1095,161 @@ def register_server2client_callback(py_callable):
     _message_notify_callback = py_callable
 
 
+# Notification/indication handler for the server2client characteristic.
+def server2client_notify_callback(value):
+    global global_received_data
+    logger.debug("Notification received: %s", value.hex())
+
+    # Ensure the received frame is not empty
+    if not value or len(value) < 1:
+        logger.error("Received an empty frame!")
+        return
+
+    # Read the marker from the first byte
+    marker = value[0]
+    if _client_tuner is not None and marker in (0x00, 0x01):
+        _client_tuner.answer_frame_received(marker == 0x00)
+
+    if marker == 0x01:
+        if len(global_received_data) == 0:
+            if _message_start_received_callback:
+                try:
+                    _message_start_received_callback()
+                    logger.info("MessageStartReceived callback fired.")
+                except Exception as e:
+                    logger.error("Error calling MessageStartReceived callback: %s", e)
+            else:
+                logger.warning("No MessageStartReceived callback is registered.")
+        # Intermediate frame: append data excluding the marker
+        global_received_data.extend(value[1:])
+    elif marker == 0x00:
+        # Final frame: append data excluding the marker
+        global_received_data.extend(value[1:])
+
+        # Now call the registered callback with the complete data
+        if _message_notify_callback:
+            try:
+                _message_notify_callback(bytes(global_received_data))
+            except Exception as e:
+                logger.error("Error calling message received callback: %s", e)
+        else:
+            logger.warning("No message received callback is registered.")
+
+        # Clear the accumulated data for the next message
+        global_received_data.clear()
+    else:
+        logger.error("Unknown frame marker: 0x%02X", marker)
+
+# ------------------------------------------------------------------------------
+# Fast connection setup for the central role.
+#
+# Only the target service is discovered (by UUID) and only the three mdoc
+# characteristics (by type). The CCCD write request and the state write command
+# are issued back to back on the same ATT bearer, so the peer sees them in order,
+# and the CCCD write response is used as the completion signal instead of a
+# fixed delay.
+# ------------------------------------------------------------------------------
+async def fast_connection_setup(peer: Peer, target_service_uuid: UUID):
+    global _global_char_client2server, _global_char_server2client
+
+    services = await peer.discover_service(target_service_uuid)
+    if not services:
+        return None
+    service = services[0]
+    logger.info(f"=== Found target service {service.uuid}, discovering characteristics")
+
+    await peer.discover_characteristics(
+        uuids=[STATE_UUID, CLIENT2SERVER_UUID, SERVER2CLIENT_UUID],
+        service=service
+    )
+
+    state_char = None
+    for char in service.characteristics:
+        if char.uuid == STATE_UUID:
+            state_char = char
+        elif char.uuid == CLIENT2SERVER_UUID:
+            _global_char_client2server = char
+            logger.info("Discovered client server characteristic")
+        elif char.uuid == SERVER2CLIENT_UUID:
+            _global_char_server2client = char
+            logger.info("Discovered server client characteristic")
+
+    cccd = None
+    if _global_char_server2client:
+        # Discover its descriptors so we can find the CCCD
+        await _global_char_server2client.discover_descriptors()
+        cccd = _global_char_server2client.get_descriptor(CCCD_UUID)
+
+        # Register the subscribers before enabling the CCCD so that no early frame is lost.
+        # Indications are needed for the Virginia wallet.
+        handle = _global_char_server2client.handle
+        peer.gatt_client.indication_subscribers.setdefault(handle, set()).add(server2client_notify_callback)
+        peer.gatt_client.notification_subscribers.setdefault(handle, set()).add(server2client_notify_callback)
+
+    pending = []
+    if cccd:
+        # Enable notifications and indications; the write response is our completion signal.
+        pending.append(peer.write_value(cccd, b'\x03\x00', with_response=True))
+    elif _global_char_server2client:
+        logger.error("Characteristic does not support NOTIFY or INDICATE")
+    if state_char:
+        pending.append(peer.write_value(state_char, bytes([STATE_START_TRANSMISSION])))
+
+    results = await asyncio.gather(*pending, return_exceptions=True)
+
+    if cccd and isinstance(results[0], Exception):
+        # some peripherals reject INDICATE; fall back to generic subscribe()
+        logger.warning(f"CCCD write failed ({results[0]}); falling back to subscribe() helper")
+        await peer.gatt_client.subscribe(
+            _global_char_server2client,
+            subscriber=server2client_notify_callback,
+            prefer_notify=True         # request NOTIFY only
+        )
+        logger.info("Subscribed via subscribe() helper")
+    elif cccd:
+        logger.info("Subscribed to server client characteristic NOTIFY & INDICATE")
+
+    if state_char:
+        if isinstance(results[-1], Exception):
+            # The wallet never received "start"; the session cannot proceed.
+            logger.error(f"State write failed: {results[-1]}")
+            return None
+        else:
+            logger.info("State written (0x01)")
+
+    return service
+
+# ------------------------------------------------------------------------------
+# Release everything a central connection registered, once it is gone.
+# ------------------------------------------------------------------------------
+def teardown_client_connection(connection):
+    global _global_peer, _global_char_client2server, _global_char_server2client
+    gatt_client = connection.gatt_client
+    for subscribers in (gatt_client.notification_subscribers, gatt_client.indication_subscribers):
+        for handle, subscriber_set in list(subscribers.items()):
+            subscriber_set.discard(server2client_notify_callback)
+            if not subscriber_set:
+                del subscribers[handle]
+
+    # disconnect_device() may already have dropped the peer.
+    if _global_peer is None or _global_peer.connection is connection:
+        _global_peer = None
+        _global_char_client2server = None
+        _global_char_server2client = None
+        finish_client_tuning()
+    global_received_data.clear()
+
+def _release_global_device():
+    global _global_device, _global_device_transport
+    if _global_device is None:
+        return
+    listener = _global_device.listener
+    if isinstance(listener, ClientListener):
+        listener.close()
+    _global_device.listener = None
+    _global_device = None
+    _global_device_transport = None
+
 class ClientListener(Device.Listener):
     def __init__(self, device, target_service_uuid):
         self.device = device
@@ -514,15 +1296,17 @@ class ClientListener(Device.Listener):
 
             self.connecting = True
             # stop scanning and connect
-            asyncio.create_task(self.device.stop_scanning())
-            asyncio.create_task(self.device.connect(addr))
+            spawn_task(self.device.stop_scanning())
+            spawn_task(self.device.connect(addr))
             #asyncio.create_task(self._stop_and_connect(addr))
 
     @AsyncRunner.run_in_task()
     async def on_connection(self, connection):
-        global _global_peer, _global_char_client2server, _global_char_server2client
+        global _global_peer, _global_char_client2server, _global_char_server2client, _client_tuner
         logger.info(f'=== Connected to {connection}')
         self.current_connection = connection
+        # Disconnection is a connection event, not a device listener callback.
+        connection.on('disconnection', lambda reason: self.on_disconnection(connection, reason))
         if _connection_init_started_callback:
             try:
                 _connection_init_started_callback()
@@ -536,139 +1320,37 @@ class ClientListener(Device.Listener):
         except Exception as e:
             logger.warning(f'Failed to negotiate MTU: {e}')
 
-        # Step 2: Discover services and characteristics
-        await _global_peer.discover_services()
-        logger.info('Services discovered')
-
-        for service in _global_peer.services:
-            logger.info(f'Discovered service UUID: {service.uuid}')
-             # Look only at your target service:
-            if service.uuid != self.target_service_uuid:
-                continue
-
-            logger.info(f"=== Found target service {service.uuid}, discovering characteristics")
-            await service.discover_characteristics()
-
-            # find the three chars
-            for char in service.characteristics:
-                if char.uuid == STATE_UUID:
-                    # your existing state write
-                    await _global_peer.write_value(char, b'\x01')
-                    logger.info("State written (0x01)")
-
-                elif char.uuid == CLIENT2SERVER_UUID:
-                    _global_char_client2server = char
-                    logger.info("Discovered client server characteristic")
-
-                elif char.uuid == SERVER2CLIENT_UUID:
-                    _global_char_server2client = char                    
-                    logger.info("Discovered server client characteristic")
-
-            # subscribe to notifications on server client
-            if _global_char_server2client:  
-                logger.info("Discovered descriptor")
-                # 1) Discover its descriptors so we can find the CCCD
-                await _global_char_server2client.discover_descriptors()
-                for desc in _global_char_server2client.descriptors:
-                    logger.info(f"    Descriptor: handle=0x{desc.handle:04x} uuid={desc.type} ")
-             
-                # define how to handle incoming notifications:
-                def _on_notify(value):                   
-                    global global_received_data
-                    logger.debug("Notification received: %s", value.hex())
-
-                    # Ensure the received frame is not empty
-                    if not value or len(value) < 1:
-                        logger.error("Received an empty frame!")
-                        return
-
-                    # Read the marker from the first byte
-                    marker = value[0]
-
-                    if marker == 0x01:
-                        if len(global_received_data) == 0:
-                            if _message_start_received_callback:
-                                try:
-                                    _message_start_received_callback()
-                                    logger.info("MessageStartReceived callback fired.")
-                                except Exception as e:
-                                    logger.error("Error calling MessageStartReceived callback: %s", e)
-                            else:
-                                logger.warning("No MessageStartReceived callback is registered.")
-                        # Intermediate frame: append data excluding the marker
-                        global_received_data.extend(value[1:])
-                    elif marker == 0x00:
-                        # Final frame: append data excluding the marker
-                        global_received_data.extend(value[1:])
-
-                        # Now call the registered callback with the complete data
-                        if _message_notify_callback:
-                            try:
-                                _message_notify_callback(bytes(global_received_data))
-                            except Exception as e:
-                                logger.error("Error calling message received callback: %s", e)
-                        else:
-                            logger.warning("No message received callback is registered.")
-
-                        # Clear the accumulated data for the next message
-                        global_received_data.clear()
-                    else:
-                        logger.error("Unknown frame marker: 0x%02X", marker)
-                               
-
-                # Check if the characteristic supports notifications or indications
-                #if _global_char_server2client.properties & Characteristic.NOTIFY:
-                logger.info("Characteristic supports NOTIFY")
-                # Ensure CCCD is correctly configured
-                cccd = _global_char_server2client.get_descriptor(CCCD_UUID)
-                if cccd:
-                    try:
-                        # Enable notifications by writing to CCCD
-                        await _global_peer.write_value(cccd, b'\x03\x00', with_response=True)
-                        logger.info("CCCD configured for both notifications and indications")
-
-                        # Manually set up the callback for indications
-                        # This is a simplified example; you may need to adjust based on your specific needs
-                        def handle_indication(value):
-                            _on_notify(value)
-
-                        # Add the callback to the indication subscribers //needed for Virghinia wallet
-                        subscriber_set = _global_peer.gatt_client.indication_subscribers.setdefault(_global_char_server2client.handle, set())
-                        subscriber_set.add(_on_notify)
-
-                        # Add the callback to  notification  subscribers
-                        notification_subscriber_set = _global_peer.gatt_client.notification_subscribers.setdefault(_global_char_server2client.handle, set())
-                        notification_subscriber_set.add(_on_notify)
-                        logger.info("Subscribed to server client characteristic NOTIFY & INDICATE")
-                    except Exception as e:
-                        # some peripherals reject INDICATE; fall back to generic subscribe()
-                        logger.warning(f"CCCD write failed ({e}); falling back to subscribe() helper")
-                        await _global_peer.gatt_client.subscribe(
-                            _global_char_server2client,
-                            subscriber=_on_notify,      
-                            prefer_notify=True         # request NOTIFY only
-                        )
-                        logger.info("Subscribed via subscribe() helper")                                  
-                else:
-                    logger.error("Characteristic does not support NOTIFY or INDICATE")
-
-                logger.info("Subscribed to server client characteristic")                     
-                # 5) Give the controller a moment to process the write
-                await asyncio.sleep(0.5)
-
-            # signal your main future so scan/connect completes
-            self.service_found_future.set_result((connection, service))
+        # Step 2: Discover the target service and its characteristics, subscribe and start
+        service = await fast_connection_setup(_global_peer, self.target_service_uuid)
+        if service is None:
+            logger.warning(f'=== Service with UUID {self.target_service_uuid} not found or not started')
+            if not self.service_found_future.done():
+                self.service_found_future.set_result(None)
             return
 
-        logger.warning(f'=== Service with UUID {self.target_service_uuid} not found')
+        # peer_address is the identity address when the keystore could resolve the peer.
+        remember_peer_address(connection)
+        _client_tuner = TransferTuner(connection.peer_address, CLIENT_TRANSFER_MODES)
+
+        # signal your main future so scan/connect completes
         if not self.service_found_future.done():
-            self.service_found_future.set_result(None)
+            self.service_found_future.set_result((connection, service))
 
     def on_disconnection(self, connection, reason):
         logger.info(f"### Disconnected {connection}, reason={reason}")
+        teardown_client_connection(connection)
         # clear it
         if self.current_connection == connection:
             self.current_connection = None
+        # A link lost during setup must not leave scan_and_connect waiting.
+        if not self.service_found_future.done():
+            self.service_found_future.set_result(None)
+        self.connecting = False
+
+    def close(self):
+        if not self.service_found_future.done():
+            self.service_found_future.cancel()
+        self.current_connection = None
   
     async def _stop_and_connect(self, addr):
         try:
@@ -679,30 +1361,84 @@ class ClientListener(Device.Listener):
             self.connecting = False  # Allow retry on failure
 
 # -----------------------------------------------------------------------------
-async def scan_and_connect(config_file: str, transport: str, target_service_uuid: UUID, timeout: int = 10):
-    global global_hci_transport, _global_device
+@profiled_session("client")
+async def scan_and_connect(config_file: str, transport: str, target_service_uuid: UUID, timeout: int = 10,
+                           peer_address: str = None, reengagement: bool = False):
+    global global_hci_transport, _global_device, _global_device_transport
+    # One budget for the whole call: the direct attempt, the service wait and the scan.
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
 
     if global_hci_transport is None:
         global_hci_transport = await open_transport_or_link(transport)
 
-    device = Device.from_config_file_with_hci(config_file, global_hci_transport.source, global_hci_transport.sink)
-
-    _global_device = device
+    # Reuse the device while the transport is unchanged instead of building a new one per session.
+    reuse_device = _global_device is not None and _global_device_transport is global_hci_transport
+    if reuse_device:
+        device = _global_device
+        if isinstance(device.listener, ClientListener):
+            device.listener.close()
+    else:
+        _release_global_device()
+        device = Device.from_config_file_with_hci(config_file, global_hci_transport.source, global_hci_transport.sink)
+        _global_device = device
+        _global_device_transport = global_hci_transport
 
     if device.is_scanning:
         await device.stop_scanning()
 
-    listener = ClientListener(device, target_service_uuid)
-
     # First, if we already have a connection, tear it down
-    if listener.current_connection is not None:
-        await listener.current_connection.disconnect()
+    for connection in list(device.connections.values()):
+        await connection.disconnect()
         logger.info("Disconnected previous connection")
 
+    listener = ClientListener(device, target_service_uuid)
     device.listener = listener
-    await device.power_on()
+    if not reuse_device:
+        await device.power_on()
+
+    # Direct-connect fast path: the handover address as given, or, when re-engaging the same
+    # wallet, the one connected to most recently.
+    address = Address(peer_address) if peer_address else (get_recent_peer_address() if reengagement else None)
+    if address is not None:
+        logger.info(f'=== Connecting directly to {address}')
+        listener.connecting = True
+        try:
+            # The outer deadline guards against controllers that never confirm the cancel, and
+            # against Bumble scanning for an identity address it holds an IRK for.
+            await asyncio.wait_for(
+                device.connect(
+                    address,
+                    connection_parameters_preferences=FAST_CONNECTION_PARAMETERS,
+                    timeout=DIRECT_CONNECT_TIMEOUT
+                ),
+                timeout=min(DIRECT_CONNECT_TIMEOUT + 1.0, max(deadline - loop.time(), 0))
+            )
+            connected = True
+        except Exception as e:
+            logger.info(f'=== Direct connection to {address} failed ({e!r}); falling back to scanning')
+            forget_peer_address(address)
+            listener.connecting = False
+            connected = False
+
+        if connected:
+            try:
+                result = await asyncio.wait_for(listener.service_found_future, timeout=max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                logger.warning('=== Timed out waiting for the service after direct connection')
+                return None
+            if result is not None:
+                return result
+
+            # The device at that address is not (or no longer) running this engagement.
+            logger.info(f'=== {address} does not offer {target_service_uuid}; falling back to scanning')
+            forget_peer_address(address)
+            for connection in list(device.connections.values()):
+                await connection.disconnect()
+            listener.close()
+            listener = ClientListener(device, target_service_uuid)
+            device.listener = listener
 
- 
     # Start scanning for devices
     logger.info('=== Scanning for devices...')
     await device.start_scanning(active=True, legacy=True)
@@ -710,7 +1446,11 @@ async def scan_and_connect(config_file: str, transport: str, target_service_uuid
 
     # Wait for the service to be found or timeout
     try:
-        result = await asyncio.wait_for(listener.service_found_future, timeout=timeout)
+        result = await asyncio.wait_for(listener.service_found_future, timeout=max(deadline - loop.time(), 0))
+        if result is None:
+            # Connected, but the setup failed: do not leave the wallet connected without a session.
+            for connection in list(device.connections.values()):
+                await connection.disconnect()
         return result
     except asyncio.TimeoutError:
         logger.warning('=== Timed out while scanning for devices')
@@ -727,7 +1467,7 @@ async def disconnect_device():
     if _global_peer:
         try:
             logger.info('[INFO] Disconnecting from device...')
-            await _global_device.disconnect(_global_peer.connection)
+            await _global_peer.connection.disconnect()
             logger.info('[INFO] Disconnected.')
         except Exception as e:
             logger.info(f'[ERROR] Failed to disconnect: {e}')
@@ -735,12 +1475,357 @@ async def disconnect_device():
             _global_peer = None
     else:
         logger.error('[INFO] No active peer to disconnect.')
+    # A client setup started ahead of the SDK for the next engagement is not part of this session.
+    prestarted = any(role == "client" and not setup.done()
+                     for (role, _), (setup, *_) in list(_prestarted_setups.items()))
+    if _global_device is not None and isinstance(_global_device.listener, ClientListener) and not prestarted:
+        _global_device.listener.close()
+    _profile_session_end()
+
+# -----------------------------------------------------------------------------
+#  Dual role: advertise our GATT service and scan for the wallet at the same time
+# -----------------------------------------------------------------------------
+class DualRoleListener(ClientListener, Connection.Listener):
+    def __init__(self, device, target_service_uuid):
+        super().__init__(device, target_service_uuid)
+        self.committed_role = None
+        self.server_connection = None
+        self.subscribed_modes = {}
+        # Resolved by the wallet's "start" write; set by setup_dual_role().
+        self.state_future = None
+
+    def on_connection(self, connection):
+        if self.committed_role is not None:
+            logger.warning(f"Already committed to {self.committed_role} role, dropping {connection}")
+            spawn_task(connection.disconnect())
+            return
+
+        if connection.role == HCI_CENTRAL_ROLE:
+            self.committed_role = "client"
+            logger.info("Dual role: outgoing connection completed first, stopping advertising")
+            spawn_task(self.device.stop_advertising())
+            super().on_connection(connection)
+        else:
+            self.committed_role = "server"
+            logger.info("Dual role: incoming connection completed first, stopping scanning")
+            # Ignore further advertisements and abandon any outgoing connection attempt.
+            self.connecting = True
+            spawn_task(self.device.stop_scanning())
+            if self.device.is_le_connecting:
+                spawn_task(self.device.cancel_connection())
+            MyListener.on_connection(self, connection)
+
+    def on_disconnection(self, *args):
+        # Bumble calls this with or without the connection depending on the listener it was registered as.
+        if len(args) == 2:
+            super().on_disconnection(*args)
+            return
+        MyListener.on_disconnection(self, args[0])
+        # The wallet dropped before writing "start": neither path is running any more, so resume both.
+        if self.committed_role == "server" and self.state_future is not None and not self.state_future.done():
+            logger.warning("Dual role: wallet disconnected before starting, advertising and scanning again")
+            self.committed_role = None
+            self.connecting = False
+            spawn_task(self._resume())
+
+    async def _resume(self):
+        try:
+            if not self.device.is_advertising:
+                await self.device.start_advertising(auto_restart=False)
+            if not self.device.is_scanning:
+                await self.device.start_scanning(active=True, legacy=True)
+        except Exception as e:
+            logger.warning(f"Dual role: failed to resume advertising and scanning: {e}")
+
+    def on_characteristic_subscription(self, connection, characteristic, notify_enabled, indicate_enabled):
+        MyListener.on_characteristic_subscription(self, connection, characteristic, notify_enabled, indicate_enabled)
+
+# ------------------------------------------------------------------------------
+# Advertise the server service and scan for the client service on one controller.
+#
+# Whichever connection completes first decides the role; the other path is
+# stopped. Returns ("server", device) once the wallet writes "start" to our
+# state characteristic, or ("client", device) once the wallet's service has been
+# set up through fast_connection_setup().
+# ------------------------------------------------------------------------------
+@profiled_session("dual")
+async def setup_dual_role(config_file: str, transport: str, server_service_uuid_str: str, ident_value: bytes,
+                          client_service_uuid_str: str, timeout: float = 30.0):
+    global global_hci_transport, _global_device
+    logger.debug("Starting dual role setup with server uuid %s, client uuid %s.",
+                 server_service_uuid_str, client_service_uuid_str)
+
+    server_service_uuid = UUID(server_service_uuid_str)
+    state_future = asyncio.get_event_loop().create_future()
+    custom_service = create_custom_service(
+        server_service_uuid,
+        lambda conn, value: state_write_callback(conn, value, state_future),
+        ident_value
+    )
+
+    if global_hci_transport is None:
+        global_hci_transport = await open_transport_or_link(transport)
+
+    _release_global_device()
+    device = Device.from_config_file_with_hci(config_file, global_hci_transport.source, global_hci_transport.sink)
+    _global_device = device
+
+    listener = DualRoleListener(device, UUID(client_service_uuid_str))
+    listener.state_future = state_future
+    device.listener = listener
+    device.add_services([custom_service])
+    await device.power_on()
+
+    device.advertising_data = bytes(
+        AdvertisingData(
+            [
+                (
+                    AdvertisingData.COMPLETE_LIST_OF_128_BIT_SERVICE_CLASS_UUIDS,
+                    bytes(server_service_uuid)
+                )
+            ]
+        )
+    )
+    logger.info(f"Advertising custom service UUID: {server_service_uuid}")
+    await device.start_advertising(auto_restart=False)
+    logger.info('=== Scanning for devices...')
+    await device.start_scanning(active=True, legacy=True)
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    pending = {state_future, listener.service_found_future}
+    while pending:
+        done, _ = await asyncio.wait(pending, timeout=max(deadline - loop.time(), 0), return_when=asyncio.FIRST_COMPLETED)
+        if not done or state_future in done:
+            break
+        if not listener.service_found_future.cancelled() and listener.service_found_future.result() is not None:
+            break
+        # The central attempt found no service or lost the link; the wallet may still connect to us.
+        logger.warning("Dual role: client role failed, still waiting for the wallet in server role")
+        pending = {state_future}
+        if listener.current_connection is not None:
+            try:
+                await listener.current_connection.disconnect()
+            except Exception as e:
+                logger.warning(f"Failed to disconnect: {e}")
+        listener.committed_role = None
+        if not device.is_advertising:
+            await device.start_advertising(auto_restart=False)
+
+    # Make sure neither path is left running.
+    if device.is_scanning:
+        await device.stop_scanning()
+    if device.is_advertising:
+        await device.stop_advertising()
+
+    if state_future.done():
+        listener.service_found_future.cancel()
+        logger.info("Dual role: committed to server role.")
+        return "server", device
+
+    state_future.cancel()
+    service_found = listener.service_found_future
+    if service_found.done() and not service_found.cancelled() and service_found.result() is not None:
+        logger.info("Dual role: committed to client role.")
+        return "client", device
+
+    logger.warning("Dual role: no engagement completed within %s seconds", timeout)
+    raise asyncio.TimeoutError()
 
 # -----------------------------------------------------------------------------
-def run_scan_and_connect(config_file: str, transport: str, target_service_uuid: str, timeout: int = 10):
+#  Device engagement parsing
+# -----------------------------------------------------------------------------
+DEVICE_RETRIEVAL_METHOD_BLE = 2
+
+class CborTag24:
+    """Embedded CBOR (#6.24); keeps the encoded item as well, as it is hashed as-is."""
+    def __init__(self, value: bytes, encoded: bytes):
+        self.value = value
+        self.encoded = encoded
+
+def _cbor_decode(data: bytes, offset: int = 0):
+    # Minimal CBOR decoder for DeviceEngagement: ints, strings, arrays, maps, tags and simple values.
+    initial = data[offset]
+    major, info = initial >> 5, initial & 0x1F
+    offset += 1
+    if info < 24:
+        argument = info
+    elif info <= 27:
+        size = 1 << (info - 24)
+        argument = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    else:
+        raise ValueError(f"Unsupported CBOR additional info {info}")
+
+    if major == 0:
+        return argument, offset
+    if major == 1:
+        return -1 - argument, offset
+    if major == 2:
+        return bytes(data[offset:offset + argument]), offset + argument
+    if major == 3:
+        return data[offset:offset + argument].decode('utf-8'), offset + argument
+    if major == 4:
+        items = []
+        for _ in range(argument):
+            item, offset = _cbor_decode(data, offset)
+            items.append(item)
+        return items, offset
+    if major == 5:
+        items = {}
+        for _ in range(argument):
+            key, offset = _cbor_decode(data, offset)
+            items[key], offset = _cbor_decode(data, offset)
+        return items, offset
+    if major == 6:
+        start = offset - (1 + (0 if info < 24 else 1 << (info - 24)))
+        item, offset = _cbor_decode(data, offset)
+        if argument == 24:
+            return CborTag24(item, bytes(data[start:offset])), offset
+        return item, offset
+    if info in (20, 21):
+        return info == 21, offset
+    if info in (22, 23):
+        return None, offset
+    raise ValueError(f"Unsupported CBOR simple value {info}")
+
+def _hkdf_sha256(ikm: bytes, salt: bytes, info: bytes, length: int) -> bytes:
+    prk = hmac.new(salt or bytes(32), ikm, hashlib.sha256).digest()
+    output, block = b'', b''
+    counter = 1
+    while len(output) < length:
+        block = hmac.new(prk, block + info + bytes([counter]), hashlib.sha256).digest()
+        output += block
+        counter += 1
+    return output[:length]
+
+class BleEngagement:
+    """BLE retrieval options of a DeviceEngagement, with the ident and advertising data precomputed."""
+    def __init__(self, engagement_str: str):
+        encoded = engagement_str[len("mdoc:"):] if engagement_str.startswith("mdoc:") else engagement_str
+        data = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+        engagement, _ = _cbor_decode(data)
+
+        self.version = engagement.get(0)
+        security = engagement.get(1) or []
+        self.e_device_key_bytes = security[1].encoded if len(security) > 1 and isinstance(security[1], CborTag24) else None
+
+        options = {}
+        for method in engagement.get(2) or []:
+            if len(method) >= 3 and method[0] == DEVICE_RETRIEVAL_METHOD_BLE:
+                options = method[2]
+                break
+        if not options:
+            raise ValueError("DeviceEngagement has no BLE retrieval method")
+
+        # Roles are those of the mdoc; the reader takes the opposite one.
+        self.peripheral_server_mode = bool(options.get(0))
+        self.central_client_mode = bool(options.get(1))
+        self.peripheral_server_uuid = str(UUID(str(uuid.UUID(bytes=options[10])))) if 10 in options else None
+        self.central_client_uuid = str(UUID(str(uuid.UUID(bytes=options[11])))) if 11 in options else None
+        address = options.get(20)
+        self.device_address = ":".join(f"{b:02X}" for b in address) if address else None
+
+        # Ident characteristic value: HKDF(EDeviceKeyBytes, "", "BLEIdent", 16).
+        self.ident = _hkdf_sha256(self.e_device_key_bytes, b'', b'BLEIdent', 16) if self.e_device_key_bytes else b''
+        self.advertising_data = None
+        if self.central_client_mode and self.central_client_uuid:
+            self.advertising_data = bytes(
+                AdvertisingData(
+                    [
+                        (
+                            AdvertisingData.COMPLETE_LIST_OF_128_BIT_SERVICE_CLASS_UUIDS,
+                            bytes(UUID(self.central_client_uuid))
+                        )
+                    ]
+                )
+            )
+
+    @property
+    def reader_role(self) -> str:
+        server = self.central_client_mode and self.central_client_uuid is not None
+        client = self.peripheral_server_mode and self.peripheral_server_uuid is not None
+        if server and client:
+            return "dual"
+        if server:
+            return "server"
+        if client:
+            return "client"
+        raise ValueError("DeviceEngagement has no usable BLE mode")
+
+ENGAGEMENT_CACHE_SIZE = 32
+_engagement_cache = OrderedDict()
+
+def parse_device_engagement(engagement_str: str) -> BleEngagement:
+    engagement = _engagement_cache.get(engagement_str)
+    if engagement is None:
+        engagement = BleEngagement(engagement_str)
+        _engagement_cache[engagement_str] = engagement
+        while len(_engagement_cache) > ENGAGEMENT_CACHE_SIZE:
+            _engagement_cache.popitem(last=False)
+        logger.info("Parsed engagement: role %s, server uuid %s, client uuid %s, address %s",
+                    engagement.reader_role, engagement.central_client_uuid,
+                    engagement.peripheral_server_uuid, engagement.device_address)
+    return engagement
+
+# Engagement setups started ahead of the SDK, by (role, service uuid): the future yielding
+# (role, device), the timeout the setup was started with and the ident it serves.
+_prestarted_setups = {}
+
+async def start_engagement(config_file: str, transport: str, engagement: BleEngagement, timeout: float = 30.0):
+    role = engagement.reader_role
+    if role == "dual":
+        return await setup_dual_role(config_file, transport, engagement.central_client_uuid, engagement.ident,
+                                     engagement.peripheral_server_uuid, timeout)
+    if role == "server":
+        device, _ = await setup_bluetooth_server(config_file, transport, engagement.central_client_uuid,
+                                                 engagement.ident, timeout, engagement.advertising_data)
+        return "server", device
+    result = await scan_and_connect(config_file, transport, UUID(engagement.peripheral_server_uuid),
+                                    timeout, engagement.device_address)
+    if result is None:
+        raise RuntimeError("Scan/connect returned None")
+    return "client", _global_device
+
+def _take_prestarted_setup(role: str, service_uuid_str: str):
+    return _prestarted_setups.pop((role, str(UUID(service_uuid_str))), None)
+
+async def _abandon_setup(device):
+    for connection in list(device.connections.values()):
+        try:
+            await connection.disconnect()
+        except Exception as e:
+            logger.warning(f"Failed to disconnect: {e}")
+
+def _join_prestarted_setup(prestarted, role: str):
+    future, timeout, _ = prestarted
+    try:
+        # The setup's own budget plus some slack.
+        started_role, device = future.result(timeout=timeout + 2)
+    except concurrent.futures.TimeoutError:
+        # Nobody will join it again; stop advertising/scanning instead of leaving it running.
+        future.cancel()
+        raise
+    if started_role != role:
+        # e.g. a dual role setup the wallet completed as the other role: nobody will use
+        # that connection, so do not leave the wallet connected.
+        for key in [key for key, (setup, *_) in _prestarted_setups.items() if setup is future]:
+            del _prestarted_setups[key]
+        asyncio.run_coroutine_threadsafe(_abandon_setup(device), global_event_loop).result(timeout=5)
+        raise RuntimeError(f"Engagement connected in {started_role} role")
+    return device
+
+# -----------------------------------------------------------------------------
+def run_scan_and_connect(config_file: str, transport: str, target_service_uuid: str, timeout: int = 10,
+                         peer_address: str = None, reengagement: bool = False):
     try:
+        prestarted = _take_prestarted_setup("client", target_service_uuid)
+        if prestarted is not None:
+            _join_prestarted_setup(prestarted, "client")
+            return True
+
         future = asyncio.run_coroutine_threadsafe(
-            scan_and_connect(config_file, transport, UUID(target_service_uuid), timeout),
+            scan_and_connect(config_file, transport, UUID(target_service_uuid), timeout, peer_address, reengagement),
             global_event_loop
         )
         connection = future.result(timeout=timeout + 2)  # Add timeout buffer
@@ -766,6 +1851,19 @@ def run_disconnect(timeout: int = 5):
         logger.error(f"[Python] Error during disconnect: {e}")
         raise
 
+async def complete_client_transfer(tuner, mode, peer):
+    # A write without response only hands the frames to the controller; a read queued behind
+    # them is answered once the peer has received them all. The CCCD is always readable.
+    cccd = _global_char_server2client.get_descriptor(CCCD_UUID) if _global_char_server2client else None
+    if mode == WRITE_WITHOUT_RESPONSE and cccd is not None:
+        try:
+            await peer.read_value(cccd)
+        except Exception as e:
+            logger.warning(f"Read after the last frame failed: {e}")
+            tuner.record_failure(mode)
+            return
+    tuner.transfer_completed()
+
 def run_send_data_to_server(data: bytes):
     if _global_char_client2server is None:
         raise RuntimeError("client2server characteristic not available")
@@ -781,20 +1879,40 @@ def run_send_data_to_server(data: bytes):
             logger.error("Could not convert data to Python bytes: %s", e)
             return
         
-    logger.info(f"Sending {data.hex()} via Peer.write_value(...)")
+    tuner = _client_tuner
+    mode = tuner.mode if tuner is not None else WRITE_WITHOUT_RESPONSE
+    logger.info(f"Sending {data.hex()} via Peer.write_value(...) ({mode})")
+    if tuner is not None:
+        tuner.record_frame(mode, len(data))
     future = asyncio.run_coroutine_threadsafe(
-        _global_peer.write_value(_global_char_client2server, data, with_response=False),
+        _global_peer.write_value(_global_char_client2server, data, with_response=(mode == WRITE_WITH_RESPONSE)),
         global_event_loop
     )
-    # this will block until the write is sent (no response expected)
-    future.result(timeout=5.0)
+    # this will block until the write is sent (or acknowledged, with response)
+    try:
+        future.result(timeout=5.0)
+    except Exception:
+        if tuner is not None:
+            tuner.record_failure(mode)
+        raise
     logger.info("send_data_to_server: write_value completed")
+    if tuner is not None and data[:1] == b'\x00':
+        # Do not hold the SDK up for the round trip.
+        global_event_loop.call_soon_threadsafe(spawn_task, complete_client_transfer(tuner, mode, _global_peer))
     return True
 
 # ------------------------------------------------------------------------------
 # Synchronous wrapper for setup.
 # ------------------------------------------------------------------------------
 def run_setup_bluetooth_server(config_file: str, transport: str, service_uuid_str: str, ident_value: bytes,):  
+    prestarted = _take_prestarted_setup("server", service_uuid_str)
+    if prestarted is not None:
+        _, _, prestarted_ident = prestarted
+        if ident_value is not None and bytes(list(ident_value)) != prestarted_ident:
+            logger.warning("Prestarted setup for %s serves ident %s, the SDK expects %s",
+                           service_uuid_str, prestarted_ident.hex(), bytes(list(ident_value)).hex())
+        return _join_prestarted_setup(prestarted, "server")
+
     # Schedule the coroutine on the persistent loop.
     future = asyncio.run_coroutine_threadsafe(
         setup_bluetooth_server(config_file, transport, service_uuid_str, ident_value),
@@ -803,6 +1921,42 @@ def run_setup_bluetooth_server(config_file: str, transport: str, service_uuid_st
     device, _ = future.result()
     return device  # Return only the device
 
+def run_setup_bluetooth_server_sets(config_file: str, transport: str, service_uuid_strs, ident_values, timeout: float = 30.0):
+    # Schedule the coroutine on the persistent loop.
+    future = asyncio.run_coroutine_threadsafe(
+        setup_bluetooth_server_sets(config_file, transport, list(service_uuid_strs), list(ident_values), timeout),
+        global_event_loop
+    )
+    device, service_uuid_str = future.result()
+    return device, service_uuid_str  # Return the device and the accepted engagement
+
+def run_setup_dual_role(config_file: str, transport: str, server_service_uuid_str: str, ident_value: bytes,
+                        client_service_uuid_str: str, timeout: float = 30.0):
+    # Schedule the coroutine on the persistent loop.
+    future = asyncio.run_coroutine_threadsafe(
+        setup_dual_role(config_file, transport, server_service_uuid_str, ident_value, client_service_uuid_str, timeout),
+        global_event_loop
+    )
+    role, device = future.result()
+    return role, device  # "server" or "client", and the device
+
+# Decode the engagement and start advertising/scanning without waiting for the SDK.
+def run_start_engagement(config_file: str, transport: str, engagement_str: str, timeout: float = 30.0):
+    engagement = parse_device_engagement(engagement_str)
+    # Setups that finished without being joined belong to abandoned engagements.
+    for key in [key for key, (setup, *_) in _prestarted_setups.items() if setup.done()]:
+        del _prestarted_setups[key]
+    future = asyncio.run_coroutine_threadsafe(
+        start_engagement(config_file, transport, engagement, timeout),
+        global_event_loop
+    )
+    role = engagement.reader_role
+    if role in ("server", "dual"):
+        _prestarted_setups[("server", engagement.central_client_uuid)] = (future, timeout, engagement.ident)
+    if role in ("client", "dual"):
+        _prestarted_setups[("client", engagement.peripheral_server_uuid)] = (future, timeout, engagement.ident)
+    return role
+
 def run_send_data(device, data: bytes):
     future = asyncio.run_coroutine_threadsafe(
         send_data_to_client(device, data),
@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# BluetoothBumble truncates its log under ~/Documents/Tap2iD at import and keeps the tuning file
+# there; point the home directory elsewhere so a soak run leaves the real ones alone.
+soak_home = tempfile.mkdtemp(prefix="bumble_soak_")
+_saved_home = {name: os.environ.get(name) for name in ("HOME", "USERPROFILE")}
+os.environ["HOME"] = os.environ["USERPROFILE"] = soak_home
+import BluetoothBumble as bb
+for name, value in _saved_home.items():
+    if value is None:
+        del os.environ[name]
+    else:
+        os.environ[name] = value
+bb.tuning_file_path = os.path.join(bb.app_folder_path, "bluetooth_bumble_tuning.json")
+
+from bumble.controller import Controller
+from bumble.core import UUID, AdvertisingData
+from bumble.device import Device
+from bumble.gatt import Service, Characteristic, CharacteristicValue
+from bumble.host import Host
+from bumble.link import LocalLink
+from bumble.transport.common import AsyncPipeSink
+
+logger = logging.getLogger(__name__)
+
+WALLET_SERVICE_UUID = "18CED8CB-943A-46E4-84EB-2AEBB00675A7"
+WALLET_ADDRESS = "F0:F1:F2:F3:F4:F5"
+READER_ADDRESS = "F0:F1:F2:F3:F4:F6"
+
+# ------------------------------------------------------------------------------
+# Memory measurement
+# ------------------------------------------------------------------------------
+def current_rss():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def object_counts():
+    gc.collect()
+    tasks = asyncio.run_coroutine_threadsafe(_count_tasks(), bb.global_event_loop).result(5)
+    return {
+        "objects": len(gc.get_objects()),
+        "tasks": tasks,
+        "background_tasks": len(bb._background_tasks),
+    }
+
+async def _count_tasks():
+    # Exclude the task doing the counting.
+    return len(asyncio.all_tasks()) - 1
+
+# ------------------------------------------------------------------------------
+# Local link: an in-process controller pair standing in for the dongle and the wallet
+# ------------------------------------------------------------------------------
+class LocalTransport:
+    def __init__(self, controller):
+        self.source = controller
+        self.sink = AsyncPipeSink(controller)
+
+    async def close(self):
+        pass
+
+class Wallet:
+    """mdoc in peripheral server mode: answers every complete request with a notification."""
+    def __init__(self, link):
+        controller = Controller("Wallet", link=link)
+        self.device = Device(address=WALLET_ADDRESS, host=Host(controller, AsyncPipeSink(controller)))
+        self.received = bytearray()
+        self.server2client = Characteristic(
+            bb.SERVER2CLIENT_UUID,
+            Characteristic.Properties.NOTIFY | Characteristic.Properties.INDICATE,
+            Characteristic.READABLE
+        )
+        self.device.add_services([
+            Service(UUID(WALLET_SERVICE_UUID), [
+                Characteristic(
+                    bb.STATE_UUID,
+                    Characteristic.Properties.NOTIFY | Characteristic.Properties.WRITE_WITHOUT_RESPONSE,
+                    Characteristic.WRITEABLE,
+                    CharacteristicValue(write=lambda conn, value: None)
+                ),
+                Characteristic(
+                    bb.CLIENT2SERVER_UUID,
+                    Characteristic.Properties.WRITE | Characteristic.Properties.WRITE_WITHOUT_RESPONSE,
+                    Characteristic.WRITEABLE,
+                    CharacteristicValue(write=self.on_client2server)
+                ),
+                self.server2client
+            ])
+        ])
+
+    async def start(self):
+        await self.device.power_on()
+        self.device.advertising_data = bytes(
+            AdvertisingData(
+                [
+                    (
+                        AdvertisingData.COMPLETE_LIST_OF_128_BIT_SERVICE_CLASS_UUIDS,
+                        bytes(UUID(WALLET_SERVICE_UUID))
+                    )
+                ]
+            )
+        )
+        await self.device.start_advertising(auto_restart=True)
+
+    def on_client2server(self, conn, value):
+        self.received.extend(value[1:])
+        if value[0] == 0x00:
+            response = bytes([0x00]) + len(self.received).to_bytes(4, "big")
+            self.received.clear()
+            bb.spawn_task(self.device.notify_subscribers(self.server2client, response))
+
+async def setup_local_link():
+    # Controllers need the running loop, so build them on the module's event loop.
+    link = LocalLink()
+    bb.global_hci_transport = LocalTransport(Controller("Reader", link=link, public_address=READER_ADDRESS))
+    wallet = Wallet(link)
+    await wallet.start()
+    return wallet
+
+# ------------------------------------------------------------------------------
+# Soak loop
+# ------------------------------------------------------------------------------
+async def _disconnect_from_wallet(wallet):
+    for connection in list(wallet.device.connections.values()):
+        await connection.disconnect()
+
+async def _leftover_state(connection, listener):
+    # Runs on the event loop, so the disconnection handlers have completed.
+    leftovers = []
+    if bb._global_peer is not None:
+        leftovers.append("_global_peer")
+    if bb._global_char_client2server is not None:
+        leftovers.append("_global_char_client2server")
+    if bb._global_char_server2client is not None:
+        leftovers.append("_global_char_server2client")
+    if bb.global_received_data:
+        leftovers.append("global_received_data")
+    gatt_client = connection.gatt_client
+    for name in ("notification_subscribers", "indication_subscribers"):
+        if any(bb.server2client_notify_callback in subscribers for subscribers in getattr(gatt_client, name).values()):
+            leftovers.append(f"gatt_client.{name}")
+    if not listener.service_found_future.done():
+        leftovers.append("service_found_future")
+    return leftovers
+
+def run_cycle(config_file: str, wallet: Wallet, payload: bytes, response_event: threading.Event, timeout: float,
+              wallet_disconnects: bool):
+    response_event.clear()
+    bb.run_scan_and_connect(config_file, "local", WALLET_SERVICE_UUID, timeout=int(timeout))
+    connection = bb._global_peer.connection
+    listener = bb._global_device.listener
+
+    # Frame the payload the way the SDK does: 0x01 for intermediate frames, 0x00 for the last one.
+    chunk_size = 180
+    chunks = [payload[i:i + chunk_size] for i in range(0, len(payload), chunk_size)] or [b'']
+    for index, chunk in enumerate(chunks):
+        marker = 0x00 if index == len(chunks) - 1 else 0x01
+        bb.run_send_data_to_server(bytes([marker]) + chunk)
+
+    if not response_event.wait(timeout):
+        raise RuntimeError("No response from wallet")
+
+    if wallet_disconnects:
+        asyncio.run_coroutine_threadsafe(_disconnect_from_wallet(wallet), bb.global_event_loop).result(timeout)
+    else:
+        bb.run_disconnect()
+    # Wait until the link is gone on our side before the next cycle.
+    deadline = time.monotonic() + timeout
+    while bb._global_device.connections and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    leftovers = asyncio.run_coroutine_threadsafe(
+        _leftover_state(connection, listener), bb.global_event_loop
+    ).result(timeout)
+    if leftovers:
+        side = "wallet" if wallet_disconnects else "reader"
+        raise RuntimeError(f"State left behind after {side}-initiated disconnect: {', '.join(leftovers)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak benchmark: connect, transfer and disconnect over a local link.")
+    parser.add_argument("--config-file", default="device1.json", help="Path to the device config file (JSON)")
+    parser.add_argument("--cycles", type=int, default=1000, help="Number of connect/transfer/disconnect cycles")
+    parser.add_argument("--wallet-disconnect-every", type=int, default=2,
+                        help="Let the wallet drop the link every Nth cycle instead of the reader (0 to disable)")
+    parser.add_argument("--warmup", type=int, default=20, help="Cycles to run before taking the baseline")
+    parser.add_argument("--payload-size", type=int, default=2048, help="Bytes sent to the wallet per cycle")
+    parser.add_argument("--timeout", type=float, default=10.0, help="Per-step timeout in seconds")
+    parser.add_argument("--max-rss-growth", type=float, default=4.0, help="Allowed RSS growth after warm-up, in MiB")
+    parser.add_argument("--max-object-growth-per-cycle", type=float, default=0.05,
+                        help="Allowed growth of gc-tracked objects per cycle after warm-up")
+    args = parser.parse_args()
+
+    # Keep logging from dominating both the timings and the memory profile.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    wallet = asyncio.run_coroutine_threadsafe(setup_local_link(), bb.global_event_loop).result(10)
+
+    response_event = threading.Event()
+    bb.register_server2client_callback(lambda data: response_event.set())
+    payload = os.urandom(args.payload_size)
+
+    baseline_rss = baseline_counts = None
+    durations = []
+    for cycle in range(args.cycles):
+        start = time.perf_counter()
+        wallet_disconnects = args.wallet_disconnect_every > 0 and (cycle + 1) % args.wallet_disconnect_every == 0
+        run_cycle(args.config_file, wallet, payload, response_event, args.timeout, wallet_disconnects)
+        durations.append(time.perf_counter() - start)
+
+        if cycle + 1 == args.warmup:
+            baseline_rss = current_rss()
+            baseline_counts = object_counts()
+        if (cycle + 1) % 100 == 0:
+            print(f"cycle {cycle + 1}: rss={current_rss()} counts={object_counts()}", flush=True)
+
+    if baseline_counts is None:
+        print(f"Ran {args.cycles} cycles, fewer than the {args.warmup} warm-up cycles; nothing to compare.")
+        return 1
+
+    final_rss = current_rss()
+    final_counts = object_counts()
+    durations.sort()
+    print(f"cycles: {args.cycles}, median {durations[len(durations) // 2] * 1000:.1f} ms, "
+          f"p95 {durations[int(len(durations) * 0.95)] * 1000:.1f} ms")
+    print(f"baseline: rss={baseline_rss} counts={baseline_counts}")
+    print(f"final:    rss={final_rss} counts={final_counts}")
+    print(f"logs and tuning file: {bb.app_folder_path}")
+
+    failures = []
+    if baseline_rss is not None and final_rss is not None:
+        rss_growth = (final_rss - baseline_rss) / (1024 * 1024)
+        if rss_growth > args.max_rss_growth:
+            failures.append(f"RSS grew by {rss_growth:.2f} MiB")
+    object_growth = final_counts["objects"] - baseline_counts["objects"]
+    measured_cycles = max(args.cycles - args.warmup, 1)
+    if object_growth / measured_cycles > args.max_object_growth_per_cycle:
+        failures.append(f"gc-tracked objects grew by {object_growth} ({object_growth / measured_cycles:.2f} per cycle)")
+    if final_counts["tasks"] > baseline_counts["tasks"]:
+        failures.append(f"asyncio tasks grew from {baseline_counts['tasks']} to {final_counts['tasks']}")
+    if final_counts["background_tasks"] > baseline_counts["background_tasks"]:
+        failures.append(f"background tasks grew from {baseline_counts['background_tasks']} to {final_counts['background_tasks']}")
+
+    if failures:
+        for failure in failures:
+            print("FAIL:", failure)
+        return 1
+    print("OK: memory and object counts stayed flat")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
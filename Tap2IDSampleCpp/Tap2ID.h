@@ -6,3 +6,17 @@ using namespace System;
 extern "C" __declspec(dllexport) int __stdcall ManagedFunction();
 extern "C" __declspec(dllexport) bool __stdcall initMDL();
 extern "C" __declspec(dllexport) bool __stdcall verifyMdl();
+
+// Status reported to VerifyMDLCallback
+enum MDLVerifyStatus
+{
+	MDL_VERIFY_OK = 0,
+	MDL_VERIFY_FAILED = 1,
+	MDL_VERIFY_CANCELLED = 2,
+	MDL_VERIFY_ERROR = 3
+};
+
+typedef void(__stdcall* VerifyMDLCallback)(int verificationHandle, MDLVerifyStatus status, void* context);
+
+extern "C" __declspec(dllexport) int __stdcall verifyMDLAsync(const char* engagement, VerifyMDLCallback callback, void* context);
+extern "C" __declspec(dllexport) bool __stdcall cancelMDLVerification(int verificationHandle);
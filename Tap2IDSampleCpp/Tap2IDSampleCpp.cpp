@@ -7,6 +7,7 @@ using namespace System;
 using namespace Tap2iDSdk;
 using namespace Tap2iDSdk::Model;
 using namespace System::Threading::Tasks;
+using namespace System::Collections::Concurrent;
 
 public delegate void   currentVeriyfyDelegate(VerifyState verifiyState);
 
@@ -15,6 +16,102 @@ void currentVeriyfyState(VerifyState verifiyState)
 	Console::WriteLine("state {0}", verifiyState);
 }
 
+// One verification started from verifyMDLAsync; it waits in the queue until the previous one has finished
+public ref class PendingVerification
+{
+public:
+	PendingVerification(int handle, String^ engagement, VerifyMDLCallback callback, void* context) :
+		handle(handle), engagement(engagement), callback(callback), context(context), started(0), completed(0)
+	{
+	}
+
+	// Continuation of the previous verification; the returned task completes when the SDK is done with this one
+	Task^ Run(Task^ previous)
+	{
+		Interlocked::Exchange(started, 1);
+		if (Interlocked::CompareExchange(completed, 0, 0) != 0)
+		{
+			// Cancelled while queued
+			return(Task::CompletedTask);
+		}
+		try
+		{
+			Task <Tap2iDResult^>^ verifyTask = Start(engagement);
+			return(verifyTask->ContinueWith(gcnew Action<Task<Tap2iDResult^>^>(this, &PendingVerification::OnVerifyCompleted)));
+		}
+		catch (Exception^ ex)
+		{
+			Console::WriteLine("Exception: {0}", ex->Message);
+			Complete(MDL_VERIFY_ERROR);
+			return(Task::CompletedTask);
+		}
+	}
+
+	void OnVerifyCompleted(Task<Tap2iDResult^>^ verifyTask)
+	{
+		MDLVerifyStatus status = MDL_VERIFY_ERROR;
+		if (verifyTask->IsFaulted)
+		{
+			for each (Exception ^ innerEx in verifyTask->Exception->InnerExceptions)
+			{
+				Console::WriteLine("Exception: {0}", innerEx->Message);
+			}
+		}
+		else if (verifyTask->IsCompletedSuccessfully)
+		{
+			status = (verifyTask->Result->ResultError == Tap2iDResultError::OK) ? MDL_VERIFY_OK : MDL_VERIFY_FAILED;
+		}
+		Complete(status);
+	}
+
+	// Reports the status once; later completions (e.g. after a cancel) are ignored.
+	// The callback always runs on a worker thread, never on the thread that called cancelMDLVerification.
+	bool Complete(MDLVerifyStatus status)
+	{
+		if (Interlocked::Exchange(completed, 1) != 0)
+		{
+			return(false);
+		}
+		Removed(handle);
+		if (callback != NULL)
+		{
+			ThreadPool::QueueUserWorkItem(gcnew WaitCallback(this, &PendingVerification::InvokeCallback), safe_cast<Object^>(static_cast<int>(status)));
+		}
+		return(true);
+	}
+
+	void InvokeCallback(Object^ status)
+	{
+		callback(handle, static_cast<MDLVerifyStatus>(safe_cast<int>(status)), context);
+	}
+
+	// Cancelling a verification that already reached the SDK also closes its Bluetooth session
+	bool Cancel()
+	{
+		if (!Complete(MDL_VERIFY_CANCELLED))
+		{
+			return(false);
+		}
+		if (Interlocked::CompareExchange(started, 0, 0) != 0)
+		{
+			TearDown();
+		}
+		return(true);
+	}
+
+	static Func<String^, Task<Tap2iDResult^>^>^ Start = nullptr;
+	static Action<int>^ Removed = nullptr;
+	static Action^ TearDown = nullptr;
+
+private:
+	int handle;
+	String^ engagement;
+	VerifyMDLCallback callback;
+	void* context;
+	int started;
+	int completed;
+};
+
 public ref class MyInitSdkResultListener : public Tap2iDSdk::Model::InitSdkResultListener
 {
 private:
@@ -87,12 +184,9 @@ public:
 		bool returnValue = false;
 		try
 		{
-				verifyDelegate = gcnew DelegateVerifyState();
-				verifyDelegate->OnVerifyState = gcnew OnVerifyState(&currentVeriyfyState);
-				currentMdocConfig = gcnew MdocConfig();
+				verifyDelegate = GetVerifyDelegate();
+				currentMdocConfig = CreateMdocConfig();
 				currentMdocConfig->DeviceEngagementString = "mdoc:owBjMS4wAYIB2BhYS6QBAiABIVgg9tfjod9RYXhBr6UUZFOE5VeZokjh8WKSPpgeIQ0fjtgiWCDSPOtUwClfNaOF-vbPkLxTQ4bfLVqjSCFrb-zv1TyCyAKBgwIBowD0AfULUNXLFbE_Lk1umcu0o6vZfsA";
-				currentMdocConfig->EngagementMode = DeviceEngagementMode::NFC;
-				currentMdocConfig->BleWriteOption = BleWriteOption::Write;
 				CIdentity^ identity = gcnew CIdentity();
 
 				Task <Tap2iDResult^>^ verifyTask = tap2idVerifier->VerifyMdocAsync(currentMdocConfig, verifyDelegate);
@@ -114,10 +208,113 @@ public:
 		return(returnValue);
 	}
 
+	// Queues a verification without blocking the caller; the callback is invoked from a worker thread.
+	// The Bluetooth transport holds a single session, so verifications run one after another, never concurrently.
+	static int verifyMdlAsync(String^ engagement, VerifyMDLCallback callback, void* context)
+	{
+		if (tap2idVerifier == nullptr || String::IsNullOrEmpty(engagement))
+		{
+			return(0);
+		}
+
+		int handle = Interlocked::Increment(nextHandle);
+		PendingVerification^ pending = gcnew PendingVerification(handle, engagement, callback, context);
+		pendingVerifications[handle] = pending;
+
+		Monitor::Enter(queueLock);
+		try
+		{
+			Task<Task^>^ queued = verificationQueue->ContinueWith<Task^>(gcnew Func<Task^, Task^>(pending, &PendingVerification::Run));
+			verificationQueue = TaskExtensions::Unwrap(queued);
+		}
+		finally
+		{
+			Monitor::Exit(queueLock);
+		}
+		return(handle);
+	}
+
+	// Reports MDL_VERIFY_CANCELLED to the callback; a queued verification never starts and a running one
+	// has its Bluetooth session torn down so that the next verification can start
+	static bool cancelVerification(int handle)
+	{
+		PendingVerification^ pending = nullptr;
+		if (!pendingVerifications->TryGetValue(handle, pending))
+		{
+			return(false);
+		}
+		return(pending->Cancel());
+	}
+
 private:
+	static MdocConfig^ CreateMdocConfig()
+	{
+		MdocConfig^ config = gcnew MdocConfig();
+		config->EngagementMode = DeviceEngagementMode::NFC;
+		config->BleWriteOption = BleWriteOption::Write;
+		return(config);
+	}
+
+	// Only one verification runs at a time, so the async path reuses a single config object
+	static Task<Tap2iDResult^>^ StartVerification(String^ engagement)
+	{
+		if (asyncMdocConfig == nullptr)
+		{
+			asyncMdocConfig = CreateMdocConfig();
+		}
+		asyncMdocConfig->DeviceEngagementString = engagement;
+		return(tap2idVerifier->VerifyMdocAsync(asyncMdocConfig, GetVerifyDelegate()));
+	}
+
+	static DelegateVerifyState^ GetVerifyDelegate()
+	{
+		if (sharedVerifyDelegate == nullptr)
+		{
+			DelegateVerifyState^ created = gcnew DelegateVerifyState();
+			created->OnVerifyState = gcnew OnVerifyState(&currentVeriyfyState);
+			Interlocked::CompareExchange<DelegateVerifyState^>(sharedVerifyDelegate, created, nullptr);
+		}
+		return(sharedVerifyDelegate);
+	}
+
+	static void RemovePending(int handle)
+	{
+		PendingVerification^ removed = nullptr;
+		pendingVerifications->TryRemove(handle, removed);
+	}
+
+	// The SDK has no cancellation token; ending the Bluetooth session makes the running verification fail fast.
+	// GattServer::Disconnect would also close the HCI transport and any setup started for a queued engagement,
+	// so the client link is dropped and a server session is ended with the "End" state instead
+	static void TearDownTransport()
+	{
+		try
+		{
+			BluetoothBumble::GattClient::Instance->Disconnect();
+			BluetoothBumble::GattServer::Instance->SendSessionTerminationAsync();
+		}
+		catch (Exception^ ex)
+		{
+			Console::WriteLine("Exception: {0}", ex->Message);
+		}
+	}
+
+	static mDLInterface()
+	{
+		PendingVerification::Start = gcnew Func<String^, Task<Tap2iDResult^>^>(&mDLInterface::StartVerification);
+		PendingVerification::Removed = gcnew Action<int>(&mDLInterface::RemovePending);
+		PendingVerification::TearDown = gcnew Action(&mDLInterface::TearDownTransport);
+	}
+
 	static IVerifyMdoc^ tap2idVerifier = nullptr;
 	static MdocConfig^ currentMdocConfig = nullptr;
 	static DelegateVerifyState^ verifyDelegate = nullptr;
+	static DelegateVerifyState^ sharedVerifyDelegate = nullptr;
+	static int nextHandle = 0;
+	static ConcurrentDictionary<int, PendingVerification^>^ pendingVerifications = gcnew ConcurrentDictionary<int, PendingVerification^>();
+	static MdocConfig^ asyncMdocConfig = nullptr;
+	static Object^ queueLock = gcnew Object();
+	static Task^ verificationQueue = Task::CompletedTask;
 };
 
 
@@ -131,4 +328,18 @@ extern "C" __declspec(dllexport) bool __stdcall verifyingMDL()
 {
 	return(mDLInterface::verifyMdl());
 
-}
\ No newline at end of file
+}
+
+extern "C" __declspec(dllexport) int __stdcall verifyMDLAsync(const char* engagement, VerifyMDLCallback callback, void* context)
+{
+	if (engagement == NULL)
+	{
+		return(0);
+	}
+	return(mDLInterface::verifyMdlAsync(gcnew String(engagement), callback, context));
+}
+
+extern "C" __declspec(dllexport) bool __stdcall cancelMDLVerification(int verificationHandle)
+{
+	return(mDLInterface::cancelVerification(verificationHandle));
+}